@@ -0,0 +1,146 @@
+"""Replay generation traffic against synthetic model latency profiles to compare routing policies.
+
+Traffic comes from the usage ledger (``--db usage.db``) or, without one, from a
+synthetic Poisson stream. Each policy sees the same arrivals; completions feed
+back into its own ModelRouter on a simulated clock, exactly as in the bot.
+
+Example:
+    python simulate_routing.py --budget 20 --cold-start black-forest-labs/FLUX.1-pro
+"""
+import argparse
+import heapq
+import random
+from typing import Dict, Any, List
+
+from telegram_bot_complete import ModelRouter, TelegramImageBot, UsageLedger
+
+# Median latency, log-normal spread and failure rate per model, roughly matching observed HF inference times
+SYNTHETIC_PROFILES = {
+    "black-forest-labs/FLUX.1-pro": {"median_ms": 22000, "sigma": 0.35, "error_rate": 0.03},
+    "black-forest-labs/FLUX.1-dev": {"median_ms": 14000, "sigma": 0.30, "error_rate": 0.03},
+    "black-forest-labs/FLUX.1-schnell": {"median_ms": 6000, "sigma": 0.25, "error_rate": 0.02},
+    "black-forest-labs/FLUX.1-schnell-Free": {"median_ms": 7000, "sigma": 0.40, "error_rate": 0.05},
+    "Kwai-Kolors/Kolors": {"median_ms": 13000, "sigma": 0.30, "error_rate": 0.04},
+    "stabilityai/stable-diffusion-3-5-large": {"median_ms": 15000, "sigma": 0.30, "error_rate": 0.03},
+    "runwayml/stable-diffusion-v1-5": {"median_ms": 5000, "sigma": 0.25, "error_rate": 0.02},
+    "stabilityai/stable-diffusion-xl-base-1.0": {"median_ms": 20000, "sigma": 0.35, "error_rate": 0.03}
+}
+
+# Share of synthetic traffic per keyword intent
+SYNTHETIC_INTENTS = {
+    "black-forest-labs/FLUX.1-pro": 0.35,
+    "Kwai-Kolors/Kolors": 0.2,
+    "black-forest-labs/FLUX.1-schnell-Free": 0.45
+}
+
+POLICIES = ("keyword", "latency_aware")
+
+
+def synthetic_traffic(rate: float, duration: float, rng: random.Random) -> List[Dict[str, Any]]:
+    """Poisson arrivals with intents drawn from SYNTHETIC_INTENTS"""
+    intents, weights = zip(*SYNTHETIC_INTENTS.items())
+    traffic = []
+    ts = 0.0
+    while True:
+        ts += rng.expovariate(rate)
+        if ts >= duration:
+            return traffic
+        traffic.append({"ts": ts, "user_id": rng.randrange(1000), "intent": rng.choices(intents, weights)[0]})
+
+
+def sample_latency(model_id: str, in_flight: int, now: float, args, rng: random.Random) -> tuple:
+    """Draw (latency_ms, success) for one request from the model's synthetic profile"""
+    profile = SYNTHETIC_PROFILES[model_id]
+    latency_ms = rng.lognormvariate(0, profile["sigma"]) * profile["median_ms"]
+    latency_ms *= 1 + max(0, in_flight - args.concurrency + 1) / args.concurrency
+    error_rate = profile["error_rate"]
+
+    # A cold-starting model answers 503 after the bot's 10 second retry, or loads very slowly
+    if model_id in args.cold_start and args.cold_start_from <= now < args.cold_start_until:
+        if rng.random() < args.cold_start_error_rate:
+            return 10000 + latency_ms, False
+        latency_ms += 30000
+
+    if rng.random() < error_rate:
+        return latency_ms, False
+    return min(latency_ms, 60000), latency_ms < 60000  # httpx timeout in generate_image
+
+
+def simulate(policy: str, traffic: List[Dict[str, Any]], models: Dict[str, Dict[str, str]],
+             args) -> Dict[str, float]:
+    """Run one routing policy over the traffic and summarise what users saw"""
+    rng = random.Random(args.seed)
+    clock = {"now": traffic[0]["ts"] if traffic else 0.0}
+    router = ModelRouter(models, concurrency=args.concurrency, clock=lambda: clock["now"])
+    budget_ms = args.budget * 1000
+    start = clock["now"]
+
+    completions = []
+    results = []
+    for job in traffic:
+        # Deliver every completion that happened before this arrival
+        while completions and completions[0][0] <= job["ts"]:
+            clock["now"], model_id, latency_ms, success = heapq.heappop(completions)
+            router.finish_job(model_id, latency_ms, success)
+        clock["now"] = job["ts"]
+
+        intent = job["intent"] if job["intent"] in SYNTHETIC_PROFILES else "black-forest-labs/FLUX.1-schnell-Free"
+        model_id = intent if policy == "keyword" else router.route(intent, budget_ms)
+
+        latency_ms, success = sample_latency(
+            model_id, router.stats[model_id]["in_flight"], job["ts"] - start, args, rng
+        )
+        router.start_job(model_id)
+        heapq.heappush(completions, (job["ts"] + latency_ms / 1000, model_id, latency_ms, success))
+        results.append((latency_ms, success, ModelRouter.QUALITY_RANK[models[model_id]["quality"]]))
+
+    if not results:
+        return {}
+
+    latencies = sorted(latency_ms for latency_ms, success, _ in results if success)
+    return {
+        "jobs": len(results),
+        "error_rate": sum(not success for _, success, _ in results) / len(results),
+        "p50_ms": latencies[len(latencies) // 2] if latencies else 0.0,
+        "p95_ms": latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+        "over_budget": sum(latency_ms > budget_ms or not success for latency_ms, success, _ in results) / len(results),
+        "mean_quality": sum(quality for _, _, quality in results) / len(results)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", help="usage ledger to replay (default: synthetic traffic)")
+    parser.add_argument("--rate", type=float, default=0.1, help="synthetic arrivals per second")
+    parser.add_argument("--duration", type=float, default=3600, help="synthetic traffic length in seconds")
+    parser.add_argument("--budget", type=float, default=30, help="per-user latency budget in seconds")
+    parser.add_argument("--concurrency", type=int, default=2, help="requests a model serves before queueing")
+    parser.add_argument("--cold-start", action="append", default=[], metavar="MODEL",
+                        help="model that is cold-starting during the cold-start window (repeatable)")
+    parser.add_argument("--cold-start-from", type=float, default=600, help="seconds into the replay")
+    parser.add_argument("--cold-start-until", type=float, default=1800, help="seconds into the replay")
+    parser.add_argument("--cold-start-error-rate", type=float, default=0.7, help="share of 503s while cold")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    if args.db:
+        traffic = UsageLedger.load_traffic(args.db)
+    else:
+        traffic = synthetic_traffic(args.rate, args.duration, random.Random(args.seed))
+
+    # The Redis client connects lazily, so building the bot just reads its model catalog
+    models = TelegramImageBot().available_models["text_to_image"]
+
+    print(f"Replaying {len(traffic)} jobs with a {args.budget:g}s budget")
+    print(f"{'policy':<15}{'error':>8}{'p50 ms':>10}{'p95 ms':>10}{'missed':>9}{'quality':>9}")
+    for policy in POLICIES:
+        summary = simulate(policy, traffic, models, args)
+        if not summary:
+            print(f"{policy:<15}no traffic")
+            continue
+        print(f"{policy:<15}{summary['error_rate']:>8.1%}{summary['p50_ms']:>10.0f}{summary['p95_ms']:>10.0f}"
+              f"{summary['over_budget']:>9.1%}{summary['mean_quality']:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
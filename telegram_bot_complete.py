@@ -3,8 +3,13 @@ import os
 import logging
 import base64
 import json
+import math
+import sqlite3
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple
 from io import BytesIO
 
 import httpx
@@ -17,6 +22,9 @@ import redis
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 HUGGINGFACE_API_KEY = os.getenv('HUGGINGFACE_API_KEY')
 REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379')
+USAGE_DB_PATH = os.getenv('USAGE_DB_PATH', 'usage.db')
+USAGE_RETENTION_DAYS = float(os.getenv('USAGE_RETENTION_DAYS', '30'))
+USAGE_ROLLUP_RETENTION_HOURS = float(os.getenv('USAGE_ROLLUP_RETENTION_HOURS', '24'))
 
 # Logging configuration
 logging.basicConfig(
@@ -25,6 +33,472 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+def parse_admin_user_ids(value: str) -> set:
+    """Parse a comma-separated list of Telegram user IDs, skipping malformed entries"""
+    admin_ids = set()
+    for entry in value.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        try:
+            admin_ids.add(int(entry))
+        except ValueError:
+            logger.warning(f"Ignoring malformed ADMIN_USER_IDS entry: {entry!r}")
+    return admin_ids
+
+ADMIN_USER_IDS = parse_admin_user_ids(os.getenv('ADMIN_USER_IDS', ''))
+
+class UsageLedger:
+    """Usage ledger written in batches to SQLite (WAL mode) with per-minute rollups"""
+    
+    # Stages timed for every generation job, stored as <stage>_ms columns
+    STAGES = ('select', 'generate', 'process', 'send')
+    
+    # Latency histogram buckets grow by 10%, so rollup percentiles are within ~10% of exact
+    LATENCY_BUCKET_BASE = 1.1
+    
+    # Longest windows read by /stats, which retention never cuts below
+    MODEL_STATS_WINDOW = 3600
+    USER_STATS_WINDOW = 86400
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS usage_events (
+            id INTEGER PRIMARY KEY,
+            ts REAL NOT NULL,
+            user_id INTEGER NOT NULL,
+            model TEXT NOT NULL,
+            intent TEXT,
+            outcome TEXT NOT NULL,
+            select_ms REAL,
+            generate_ms REAL,
+            process_ms REAL,
+            send_ms REAL,
+            total_ms REAL NOT NULL,
+            bytes_in INTEGER NOT NULL DEFAULT 0,
+            bytes_out INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_usage_events_user_ts ON usage_events (user_id, ts);
+        CREATE INDEX IF NOT EXISTS idx_usage_events_model_ts ON usage_events (model, ts);
+        CREATE TABLE IF NOT EXISTS usage_rollup (
+            minute INTEGER NOT NULL,
+            model TEXT NOT NULL,
+            latency_bucket INTEGER NOT NULL,
+            requests INTEGER NOT NULL,
+            errors INTEGER NOT NULL,
+            bytes_out INTEGER NOT NULL,
+            PRIMARY KEY (minute, model, latency_bucket)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS usage_generate_rollup (
+            minute INTEGER NOT NULL,
+            model TEXT NOT NULL,
+            latency_bucket INTEGER NOT NULL,
+            requests INTEGER NOT NULL,
+            errors INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (minute, model, latency_bucket)
+        ) WITHOUT ROWID;
+    """
+    
+    def __init__(self, db_path: str, flush_interval: float = 2.0, batch_size: int = 200,
+                 health_window: int = 600, event_retention: float = 30 * 86400,
+                 rollup_retention: float = 86400, prune_interval: float = 3600):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.health_window = health_window  # seconds of history behind model_health
+        
+        # Seconds of raw events and per-minute rollups kept on disk
+        self.event_retention = max(event_retention, self.USER_STATS_WINDOW)
+        self.rollup_retention = max(rollup_retention, self.MODEL_STATS_WINDOW, health_window)
+        self.prune_interval = prune_interval
+        self._last_prune: Optional[float] = None
+        self.pending: List[Dict[str, Any]] = []
+        self.model_health: Dict[str, Dict[str, float]] = {}
+        
+        # All SQLite access runs on this single thread so the event loop never blocks on disk
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='usage-ledger')
+        self._conn: Optional[sqlite3.Connection] = None
+        self._flush_requested: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+    
+    async def start(self):
+        """Open the database and start the background flush loop"""
+        await self._run_in_executor(self._open)
+        self._flush_requested = asyncio.Event()
+        self._task = asyncio.create_task(self._flush_loop())
+        logger.info(f"Usage ledger writing to {self.db_path}")
+    
+    async def close(self):
+        """Stop the flush loop and write out anything still pending"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self.flush()
+        await self._run_in_executor(self._conn.close)
+        self._executor.shutdown()
+    
+    def record(self, user_id: int, model: str, outcome: str, stage_ms: Dict[str, float],
+               total_ms: float, bytes_in: int = 0, bytes_out: int = 0, intent: str = None):
+        """Queue one job's usage row; the write happens later in a batch
+        
+        ``intent`` is the model requested before latency-aware routing, kept so
+        recorded traffic can be replayed against other routing policies.
+        """
+        if self._task is None:
+            return
+        
+        self.pending.append({
+            "ts": time.time(),
+            "user_id": user_id,
+            "model": model,
+            "intent": intent,
+            "outcome": outcome,
+            **{f"{stage}_ms": stage_ms.get(stage) for stage in self.STAGES},
+            "total_ms": total_ms,
+            "bytes_in": bytes_in,
+            "bytes_out": bytes_out
+        })
+        if len(self.pending) >= self.batch_size:
+            self._flush_requested.set()
+    
+    async def flush(self):
+        """Write pending rows and refresh the model health snapshot"""
+        batch, self.pending = self.pending, []
+        try:
+            self.model_health = await self._run_in_executor(self._write_batch, batch)
+        except Exception as e:
+            logger.error(f"Error writing usage ledger, dropped {len(batch)} rows: {e}")
+    
+    async def model_stats(self, window_seconds: int = MODEL_STATS_WINDOW) -> Dict[str, Dict[str, float]]:
+        """Per-model request count, error rate and latency percentiles from the rollups"""
+        return await self._run_in_executor(self._query_model_stats, time.time() - window_seconds)
+    
+    async def user_stats(self, user_id: int, window_seconds: int = USER_STATS_WINDOW) -> Dict[str, Any]:
+        """Request count, success count, mean latency and bytes sent for one user"""
+        return await self._run_in_executor(self._query_user_stats, user_id, time.time() - window_seconds)
+    
+    @staticmethod
+    def load_traffic(db_path: str) -> List[Dict[str, Any]]:
+        """Read recorded jobs (arrival time, user, requested model) in arrival order"""
+        conn = sqlite3.connect(db_path)
+        try:
+            # Rows are stamped on completion, so back out the job's duration
+            rows = conn.execute(
+                "SELECT ts - total_ms / 1000.0 AS arrival, user_id, COALESCE(intent, model) "
+                "FROM usage_events ORDER BY arrival"
+            ).fetchall()
+        finally:
+            conn.close()
+        return [{"ts": ts, "user_id": user_id, "intent": intent} for ts, user_id, intent in rows]
+    
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            await self.flush()
+            
+            if self._last_prune is None or time.monotonic() - self._last_prune >= self.prune_interval:
+                self._last_prune = time.monotonic()
+                await self.prune()
+    
+    async def prune(self):
+        """Delete raw events and rollup minutes older than their retention"""
+        try:
+            deleted = await self._run_in_executor(self._prune, time.time())
+        except Exception as e:
+            logger.error(f"Error pruning usage ledger: {e}")
+            return
+        if deleted:
+            logger.info(f"Pruned {deleted} expired usage ledger rows")
+    
+    async def _run_in_executor(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+    
+    def _open(self):
+        self._conn = sqlite3.connect(self.db_path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        
+        # Ledgers created before routing was recorded lack the intent column
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(usage_events)")}
+        if "intent" not in columns:
+            self._conn.execute("ALTER TABLE usage_events ADD COLUMN intent TEXT")
+        
+        # ...and their generate rollup only counted successes
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(usage_generate_rollup)")}
+        if "errors" not in columns:
+            self._conn.execute(
+                "ALTER TABLE usage_generate_rollup ADD COLUMN errors INTEGER NOT NULL DEFAULT 0"
+            )
+    
+    def _prune(self, now: float) -> int:
+        rollup_cutoff = int((now - self.rollup_retention) // 60)
+        with self._conn:
+            deleted = self._conn.execute(
+                "DELETE FROM usage_events WHERE ts < ?", (now - self.event_retention,)
+            ).rowcount
+            for table in ("usage_rollup", "usage_generate_rollup"):
+                deleted += self._conn.execute(
+                    f"DELETE FROM {table} WHERE minute < ?", (rollup_cutoff,)
+                ).rowcount
+        return deleted
+    
+    def _latency_bucket(self, latency_ms: float) -> int:
+        if latency_ms <= 1:
+            return 0
+        return math.ceil(math.log(latency_ms, self.LATENCY_BUCKET_BASE))
+    
+    def _write_batch(self, batch: List[Dict[str, Any]]) -> Dict[str, Dict[str, float]]:
+        if batch:
+            # Pre-aggregate the batch so each rollup cell is upserted once
+            rollup = defaultdict(lambda: [0, 0, 0])
+            for row in batch:
+                key = (int(row["ts"] // 60), row["model"], self._latency_bucket(row["total_ms"]))
+                rollup[key][0] += 1
+                rollup[key][1] += row["outcome"] != "success"
+                rollup[key][2] += row["bytes_out"]
+            
+            # Generate-stage outcomes, the same measure ModelRouter tracks: successes by
+            # latency bucket in requests, failures in errors. Processing only runs once
+            # generation returned an image, so a missing process time means it failed.
+            generate_rollup = defaultdict(lambda: [0, 0])
+            for row in batch:
+                if row["generate_ms"] is None:
+                    continue
+                key = (int(row["ts"] // 60), row["model"], self._latency_bucket(row["generate_ms"]))
+                generate_rollup[key][row["process_ms"] is None] += 1
+            
+            columns = ["ts", "user_id", "model", "intent", "outcome",
+                       *(f"{stage}_ms" for stage in self.STAGES),
+                       "total_ms", "bytes_in", "bytes_out"]
+            with self._conn:
+                self._conn.executemany(
+                    f"INSERT INTO usage_events ({', '.join(columns)}) "
+                    f"VALUES ({', '.join('?' for _ in columns)})",
+                    [tuple(row[column] for column in columns) for row in batch]
+                )
+                self._conn.executemany(
+                    "INSERT INTO usage_rollup (minute, model, latency_bucket, requests, errors, bytes_out) "
+                    "VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (minute, model, latency_bucket) DO UPDATE SET "
+                    "requests = requests + excluded.requests, "
+                    "errors = errors + excluded.errors, "
+                    "bytes_out = bytes_out + excluded.bytes_out",
+                    [(*key, *totals) for key, totals in rollup.items()]
+                )
+                self._conn.executemany(
+                    "INSERT INTO usage_generate_rollup (minute, model, latency_bucket, requests, errors) "
+                    "VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (minute, model, latency_bucket) DO UPDATE SET "
+                    "requests = requests + excluded.requests, "
+                    "errors = errors + excluded.errors",
+                    [(*key, *totals) for key, totals in generate_rollup.items()]
+                )
+        
+        return self._query_model_stats(time.time() - self.health_window)
+    
+    def _query_model_stats(self, since: float) -> Dict[str, Dict[str, float]]:
+        rows = self._conn.execute(
+            "SELECT model, latency_bucket, SUM(requests), SUM(errors), SUM(bytes_out) "
+            "FROM usage_rollup WHERE minute >= ? "
+            "GROUP BY model, latency_bucket ORDER BY model, latency_bucket",
+            (int(since // 60),)
+        ).fetchall()
+        
+        histograms = defaultdict(list)
+        for model, bucket, requests, errors, bytes_out in rows:
+            histograms[model].append((bucket, requests, errors, bytes_out))
+        
+        generate_rows = self._conn.execute(
+            "SELECT model, latency_bucket, SUM(requests), SUM(errors) "
+            "FROM usage_generate_rollup WHERE minute >= ? "
+            "GROUP BY model, latency_bucket ORDER BY model, latency_bucket",
+            (int(since // 60),)
+        ).fetchall()
+        
+        generate_histograms = defaultdict(list)
+        for model, bucket, successes, errors in generate_rows:
+            generate_histograms[model].append((bucket, successes, errors, 0))
+        
+        stats = {}
+        for model, histogram in histograms.items():
+            requests = sum(cell[1] for cell in histogram)
+            errors = sum(cell[2] for cell in histogram)
+            stats[model] = {
+                "requests": requests,
+                "errors": errors,
+                "error_rate": errors / requests,
+                "bytes_out": sum(cell[3] for cell in histogram),
+                "p50_ms": self._percentile(histogram, requests, 0.50),
+                "p95_ms": self._percentile(histogram, requests, 0.95),
+                "generate_requests": 0,
+                "generate_error_rate": 0.0,
+                "generate_p50_ms": None
+            }
+            
+            generate_histogram = generate_histograms.get(model, [])
+            generate_successes = sum(cell[1] for cell in generate_histogram)
+            generate_requests = generate_successes + sum(cell[2] for cell in generate_histogram)
+            if generate_requests:
+                stats[model]["generate_requests"] = generate_requests
+                stats[model]["generate_error_rate"] = 1 - generate_successes / generate_requests
+            if generate_successes:
+                stats[model]["generate_p50_ms"] = self._percentile(generate_histogram, generate_successes, 0.50)
+        return stats
+    
+    def _percentile(self, histogram: List[tuple], total: int, quantile: float) -> float:
+        """Upper bound of the histogram bucket holding the given quantile"""
+        rank = quantile * total
+        seen = 0
+        for bucket, requests, _, _ in histogram:
+            seen += requests
+            if seen >= rank:
+                return self.LATENCY_BUCKET_BASE ** bucket
+        return self.LATENCY_BUCKET_BASE ** histogram[-1][0]
+    
+    def _query_user_stats(self, user_id: int, since: float) -> Dict[str, Any]:
+        requests, successes, avg_ms, bytes_out = self._conn.execute(
+            "SELECT COUNT(*), SUM(outcome = 'success'), AVG(total_ms), SUM(bytes_out) "
+            "FROM usage_events WHERE user_id = ? AND ts >= ?",
+            (user_id, since)
+        ).fetchone()
+        return {
+            "requests": requests,
+            "successes": successes or 0,
+            "avg_ms": avg_ms or 0.0,
+            "bytes_out": bytes_out or 0
+        }
+
+class ModelRouter:
+    """Latency-aware model routing from live per-model statistics"""
+    
+    QUALITY_RANK = {"Good": 1, "High": 2, "Very High": 3, "Highest": 4}
+    
+    # Latency assumed for a model that has not been observed yet, by advertised speed
+    SPEED_PRIOR_MS = {"Very Fast": 3000.0, "Fast": 8000.0, "Medium": 15000.0, "Slow": 25000.0}
+    
+    def __init__(self, models: Dict[str, Dict[str, str]], alpha: float = 0.2,
+                 max_error_rate: float = 0.5, error_half_life: float = 300.0,
+                 latency_half_life: float = 900.0, probe_interval: float = 600.0,
+                 concurrency: int = 2, min_seed_samples: int = 5, clock=time.monotonic):
+        self.models = models
+        self.alpha = alpha  # EWMA weight of the newest observation
+        self.max_error_rate = max_error_rate
+        self.error_half_life = error_half_life  # seconds for an idle model's error rate to halve
+        self.latency_half_life = latency_half_life  # seconds for idle latency to halve its gap to the prior
+        self.probe_interval = probe_interval  # seconds before a stale over-budget intent is retried
+        self.concurrency = concurrency  # requests a model serves in parallel before queueing
+        self.min_seed_samples = min_seed_samples  # ledger generations needed before seed() trusts them
+        self.clock = clock
+        self.stats = {
+            model_id: {
+                "prior_ms": self.SPEED_PRIOR_MS.get(info["speed"], 15000.0),
+                "latency_ms": self.SPEED_PRIOR_MS.get(info["speed"], 15000.0),
+                "error_rate": 0.0,
+                "in_flight": 0,
+                "samples": 0,
+                "updated": clock(),
+                "last_started": clock()
+            }
+            for model_id, info in models.items()
+        }
+    
+    def seed(self, model_health: Dict[str, Dict[str, float]]):
+        """Start models with no live observations from usage ledger history
+        
+        Meant to run once at startup; afterwards seeded values decay like live ones.
+        """
+        for model_id, health in model_health.items():
+            stats = self.stats.get(model_id)
+            if stats is None or stats["samples"] or health["generate_requests"] < self.min_seed_samples:
+                continue
+            if health["generate_p50_ms"] is not None:
+                stats["latency_ms"] = health["generate_p50_ms"]
+            stats["error_rate"] = health["generate_error_rate"]
+            stats["updated"] = self.clock()
+    
+    def start_job(self, model_id: str):
+        """Count a request as queued on a model"""
+        if model_id in self.stats:
+            self.stats[model_id]["in_flight"] += 1
+            self.stats[model_id]["last_started"] = self.clock()
+    
+    def finish_job(self, model_id: str, latency_ms: float, success: bool):
+        """Fold a finished request into the model's EWMA latency and error rate"""
+        stats = self.stats.get(model_id)
+        if stats is None:
+            return
+        
+        stats["in_flight"] = max(0, stats["in_flight"] - 1)
+        stats["latency_ms"] = self.latency_ms(model_id)
+        stats["error_rate"] = (1 - self.alpha) * self.error_rate(model_id) + self.alpha * (not success)
+        stats["updated"] = self.clock()
+        stats["samples"] += 1
+        
+        # Failed calls end early or at the timeout, so only successes say how long a result takes
+        if success:
+            stats["latency_ms"] = (1 - self.alpha) * stats["latency_ms"] + self.alpha * latency_ms
+    
+    def latency_ms(self, model_id: str) -> float:
+        """EWMA latency drifting back to the speed prior while the model sits idle"""
+        stats = self.stats[model_id]
+        idle = self.clock() - stats["updated"]
+        decay = 0.5 ** (idle / self.latency_half_life)
+        return stats["prior_ms"] + (stats["latency_ms"] - stats["prior_ms"]) * decay
+    
+    def error_rate(self, model_id: str) -> float:
+        """Error rate decayed by idle time, so a skipped model is eventually retried"""
+        stats = self.stats[model_id]
+        idle = self.clock() - stats["updated"]
+        return stats["error_rate"] * 0.5 ** (idle / self.error_half_life)
+    
+    def expected_latency_ms(self, model_id: str) -> float:
+        """EWMA latency stretched by the requests waiting beyond the model's concurrency"""
+        queued = max(0, self.stats[model_id]["in_flight"] - self.concurrency + 1)
+        return self.latency_ms(model_id) * (1 + queued / self.concurrency)
+    
+    def is_healthy(self, model_id: str) -> bool:
+        return self.error_rate(model_id) < self.max_error_rate
+    
+    def route(self, intent: str, latency_budget_ms: float) -> str:
+        """Pick the intended model if it fits the budget, else the best-quality model that does"""
+        if intent not in self.stats:
+            return intent
+        
+        healthy = [model_id for model_id in self.stats if self.is_healthy(model_id)]
+        if intent in healthy and self.expected_latency_ms(intent) <= latency_budget_ms:
+            return intent
+        
+        # Occasionally retry an idle intent whose estimate is stale, but only for a budget
+        # its speed prior fits, so a probe never knowingly breaks the user's budget
+        stats = self.stats[intent]
+        if (intent in healthy and not stats["in_flight"]
+                and stats["prior_ms"] <= latency_budget_ms
+                and self.clock() - stats["last_started"] >= self.probe_interval):
+            return intent
+        
+        within_budget = [model_id for model_id in healthy
+                         if self.expected_latency_ms(model_id) <= latency_budget_ms]
+        if within_budget:
+            return max(within_budget, key=lambda model_id: (
+                self.QUALITY_RANK.get(self.models[model_id]["quality"], 0),
+                -self.expected_latency_ms(model_id)
+            ))
+        
+        # Nothing fits the budget: the fastest healthy model gets closest
+        if healthy:
+            return min(healthy, key=self.expected_latency_ms)
+        return intent
+
 class TelegramImageBot:
     def __init__(self):
         self.redis_client = redis.from_url(REDIS_URL)
@@ -32,6 +506,12 @@ class TelegramImageBot:
         self.default_model = "black-forest-labs/FLUX.1-schnell-Free"
         self.max_prompt_length = 500
         self.rate_limit_per_user = 10  # requests per hour
+        self.default_latency_budget_ms = 30000  # per user, overridable with /setbudget
+        self.usage_ledger = UsageLedger(
+            USAGE_DB_PATH,
+            event_retention=USAGE_RETENTION_DAYS * 86400,
+            rollup_retention=USAGE_ROLLUP_RETENTION_HOURS * 3600
+        )
         
         # Available models organized by category
         self.available_models = {
@@ -145,6 +625,24 @@ class TelegramImageBot:
             "text_to_text": "meta-llama/Llama-2-7b-chat-hf",
             "image_to_text": "Salesforce/blip-image-captioning-large"
         }
+        
+        self.model_router = ModelRouter(self.available_models["text_to_image"])
+    
+    async def post_init(self, application: Application):
+        """Start background services once the application is initialized"""
+        try:
+            await self.usage_ledger.start()
+        except Exception as e:
+            logger.error(f"Usage ledger disabled, could not open {USAGE_DB_PATH}: {e}")
+            return
+        
+        # Models start from the ledger's recent history rather than their speed prior
+        await self.usage_ledger.flush()
+        self.model_router.seed(self.usage_ledger.model_health)
+    
+    async def post_shutdown(self, application: Application):
+        """Flush background services before the process exits"""
+        await self.usage_ledger.close()
     
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle the /start command"""
@@ -159,6 +657,7 @@ This bot creates stunning images from your text descriptions using advanced AI m
 /generate <prompt> - Generate an image from text
 /models - View available AI models
 /setmodel <model_name> - Set your preferred model
+/setbudget <seconds> - Set how long you are willing to wait
 /enhance <prompt> - Enhance your prompt with AI
 /settings - Configure your preferences
 
@@ -197,6 +696,7 @@ Ready to create amazing images? Send me your first prompt! ✨
 
 **Advanced Features:**
 • Use `/setmodel <name>` to set your preferred AI model
+• Use `/setbudget <seconds>` to cap generation time; slow or failing models are skipped
 • Send `/enhance <prompt>` to improve your prompts with AI
 • Send images to get detailed descriptions
 • The bot automatically selects optimal models for your prompts
@@ -299,14 +799,8 @@ Need more help? Just ask me anything! 🤔
                     return model_id
         return None
     
-    def select_optimal_model(self, prompt: str, user_preference: str = None) -> str:
-        """Select optimal model based on prompt analysis and user preference"""
-        if user_preference:
-            model_id = self.get_model_by_name(user_preference)
-            if model_id:
-                return model_id
-        
-        # Analyze prompt characteristics
+    def get_prompt_intent(self, prompt: str) -> str:
+        """Pick the model a prompt asks for from its keywords"""
         prompt_lower = prompt.lower()
         
         # High quality/detail requirements
@@ -324,6 +818,34 @@ Need more help? Just ask me anything! 🤔
         # Default to balanced option
         return self.default_models["text_to_image"]
     
+    def select_optimal_model(self, prompt: str, user_preference: str = None,
+                             latency_budget_ms: float = None) -> Tuple[str, str]:
+        """Select optimal model based on prompt analysis, user preference and live latency
+        
+        Returns the selected model and the intended model it was routed from.
+        """
+        if user_preference:
+            # /setmodel stores the model ID; a display name is accepted as well
+            if user_preference in self.model_router.stats:
+                return user_preference, user_preference
+            model_id = self.get_model_by_name(user_preference)
+            if model_id:
+                return model_id, model_id
+        
+        if latency_budget_ms is None:
+            latency_budget_ms = self.default_latency_budget_ms
+        
+        intent = self.get_prompt_intent(prompt)
+        model_id = self.model_router.route(intent, latency_budget_ms)
+        if model_id != intent:
+            logger.info(
+                f"Routed {intent} to {model_id}: expected "
+                f"{self.model_router.expected_latency_ms(intent):.0f} ms, "
+                f"error rate {self.model_router.error_rate(intent):.0%}, "
+                f"budget {latency_budget_ms:.0f} ms"
+            )
+        return model_id, intent
+    
     def enhance_prompt(self, prompt: str) -> str:
         """Enhance the prompt for better image generation"""
         enhancement_suffixes = [
@@ -459,13 +981,24 @@ Need more help? Just ask me anything! 🤔
         user_id = update.effective_user.id
         user_model = self.redis_client.get(f"user_model:{user_id}")
         user_model = user_model.decode('utf-8') if user_model else None
+        user_budget = self.redis_client.get(f"user_latency_budget:{user_id}")
+        user_budget = float(user_budget) if user_budget else None
+        
+        # Per-stage timings and sizes for the usage ledger
+        job_start = time.perf_counter()
+        stage_ms = {}
+        selected_model = intent = None
+        outcome = "error"
+        bytes_in = bytes_out = 0
         
         try:
             # Sanitize and enhance the prompt
             sanitized_prompt = self.sanitize_prompt(prompt)
             
             # Select optimal model for this prompt, considering user preference
-            selected_model = self.select_optimal_model(sanitized_prompt, user_model)
+            stage_start = time.perf_counter()
+            selected_model, intent = self.select_optimal_model(sanitized_prompt, user_model, user_budget)
+            stage_ms["select"] = (time.perf_counter() - stage_start) * 1000
             
             # Enhance the prompt
             enhanced_prompt = self.enhance_prompt(sanitized_prompt)
@@ -484,11 +1017,22 @@ Need more help? Just ask me anything! 🤔
             )
             
             # Generate the image with selected model
-            image_data = await self.generate_image(enhanced_prompt, selected_model)
+            stage_start = time.perf_counter()
+            self.model_router.start_job(selected_model)
+            image_data = None
+            try:
+                image_data = await self.generate_image(enhanced_prompt, selected_model)
+            finally:
+                stage_ms["generate"] = (time.perf_counter() - stage_start) * 1000
+                self.model_router.finish_job(selected_model, stage_ms["generate"], image_data is not None)
             
             if image_data:
                 # Process and optimize the image
+                stage_start = time.perf_counter()
                 processed_image = self.process_image(image_data)
+                stage_ms["process"] = (time.perf_counter() - stage_start) * 1000
+                bytes_in = len(image_data)
+                bytes_out = processed_image.getbuffer().nbytes
                 
                 # Prepare metadata
                 generation_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -499,10 +1043,13 @@ Need more help? Just ask me anything! 🤔
                           f"**Quality:** {next((info['quality'] for category in self.available_models.values() for model_id, info in category.items() if model_id == selected_model), 'Unknown')}")
                 
                 # Send the image
+                stage_start = time.perf_counter()
                 await update.message.reply_photo(
                     photo=processed_image,
                     caption=caption
                 )
+                stage_ms["send"] = (time.perf_counter() - stage_start) * 1000
+                outcome = "success"
                 
                 # Delete processing message
                 await processing_msg.delete()
@@ -511,6 +1058,7 @@ Need more help? Just ask me anything! 🤔
                 logger.info(f"Image generated for user {user_id}: {sanitized_prompt}")
                 
             else:
+                outcome = "failed"
                 await processing_msg.edit_text(
                     "❌ Sorry, I couldn't generate the image. The AI service might be temporarily unavailable. Please try again in a few minutes."
                 )
@@ -522,6 +1070,15 @@ Need more help? Just ask me anything! 🤔
             await update.message.reply_text(
                 "❌ An unexpected error occurred. Please try again later."
             )
+        finally:
+            # Prompts rejected before model selection are not generation jobs
+            if selected_model:
+                self.usage_ledger.record(
+                    user_id, selected_model, outcome, stage_ms,
+                    total_ms=(time.perf_counter() - job_start) * 1000,
+                    bytes_in=bytes_in, bytes_out=bytes_out,
+                    intent=intent
+                )
     
     async def setmodel_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle the /setmodel command"""
@@ -558,6 +1115,28 @@ Need more help? Just ask me anything! 🤔
                 f"Use `/models` to see available models."
             )
     
+    async def setbudget_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle the /setbudget command"""
+        try:
+            budget_seconds = float(context.args[0])
+            if not math.isfinite(budget_seconds) or budget_seconds <= 0:
+                raise ValueError
+        except (IndexError, ValueError):
+            await update.message.reply_text(
+                "❌ Please specify how many seconds you are willing to wait.\n"
+                "Example: `/setbudget 15`"
+            )
+            return
+        
+        user_id = update.effective_user.id
+        self.redis_client.setex(f"user_latency_budget:{user_id}", 86400, budget_seconds * 1000)  # 24 hours
+        
+        await update.message.reply_text(
+            f"✅ Latency budget set to **{budget_seconds:g} seconds**\n"
+            f"⚡ When your preferred model is too slow, the best model that can finish in time is used.\n\n"
+            f"This preference will be remembered for 24 hours."
+        )
+    
     async def enhance_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle the /enhance command"""
         if not context.args:
@@ -659,6 +1238,58 @@ Need more help? Just ask me anything! 🤔
                 "❌ Sorry, I couldn't analyze the image. Please try again."
             )
     
+    async def stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle the /stats command (admins only)"""
+        if update.effective_user.id not in ADMIN_USER_IDS:
+            await update.message.reply_text("❌ This command is only available to bot admins.")
+            return
+        
+        # Per-user summary when a user ID is given
+        target_user = None
+        if context.args:
+            try:
+                target_user = int(context.args[0])
+            except ValueError:
+                await update.message.reply_text(
+                    "❌ Please specify a numeric user ID.\n"
+                    "Example: `/stats 123456789`"
+                )
+                return
+        
+        try:
+            if target_user is not None:
+                stats = await self.usage_ledger.user_stats(target_user)
+                await update.message.reply_text(
+                    f"📊 **Usage for user {target_user} (last 24h)**\n\n"
+                    f"├ Requests: {stats['requests']} | Successful: {stats['successes']}\n"
+                    f"├ Avg latency: {stats['avg_ms']:.0f} ms\n"
+                    f"└ Sent: {stats['bytes_out'] / 1024:.0f} KB"
+                )
+                return
+            
+            model_stats = await self.usage_ledger.model_stats()
+        except Exception as e:
+            logger.error(f"Error in stats command: {e}")
+            await update.message.reply_text("❌ Usage statistics are unavailable right now.")
+            return
+        
+        if not model_stats:
+            await update.message.reply_text("📊 No generations recorded in the last hour.")
+            return
+        
+        stats_text = "📊 **Usage Stats (last hour)**\n\n"
+        for model_id, stats in sorted(model_stats.items(), key=lambda item: -item[1]['requests']):
+            model_name = next(
+                (info['name'] for category in self.available_models.values()
+                 for mid, info in category.items() if mid == model_id),
+                model_id.split('/')[-1]
+            )
+            stats_text += f"**{model_name}**\n"
+            stats_text += f"├ Requests: {stats['requests']} | Errors: {stats['error_rate']:.1%}\n"
+            stats_text += f"└ p50: {stats['p50_ms']:.0f} ms | p95: {stats['p95_ms']:.0f} ms\n\n"
+        
+        await update.message.reply_text(stats_text)
+    
     async def generate_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle the /generate command"""
         if not context.args:
@@ -679,7 +1310,13 @@ def main():
     bot = TelegramImageBot()
     
     # Create application
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .post_init(bot.post_init)
+        .post_shutdown(bot.post_shutdown)
+        .build()
+    )
     
     # Add handlers
     application.add_handler(CommandHandler("start", bot.start_command))
@@ -687,7 +1324,9 @@ def main():
     application.add_handler(CommandHandler("models", bot.models_command))
     application.add_handler(CommandHandler("generate", bot.generate_command))
     application.add_handler(CommandHandler("setmodel", bot.setmodel_command))
+    application.add_handler(CommandHandler("setbudget", bot.setbudget_command))
     application.add_handler(CommandHandler("enhance", bot.enhance_command))
+    application.add_handler(CommandHandler("stats", bot.stats_command))
     application.add_handler(MessageHandler(filters.PHOTO, bot.handle_photo))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, bot.handle_text_message))
     